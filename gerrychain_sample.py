@@ -15,16 +15,57 @@ from gerrychain.proposals import propose_random_flip
 from gerrychain.accept import always_accept
 import pandas as pd
 import matplotlib.pyplot as plt
-from gerrychain import (GeographicPartition, proposals, updaters, constraints, accept)
+from gerrychain import (constraints, accept)
 from gerrychain.tree_proposals import recom
+from gerrychain.tree import (PopulatedGraph, bipartition_tree,
+                             contract_leaves_until_balanced_or_none)
 from functools import partial
+from collections import deque
+import multiprocessing as mp
+import networkx as nx
+import numpy as np
+import os
+import random
+import tracemalloc
 import tqdm
+from scipy.sparse import csr_matrix
+
+# Numba is optional; without it the contiguity check below runs in pure Python.
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# rustworkx is optional too; without it ReCom draws its spanning trees with
+# NetworkX, as GerryChain does by default.
+try:
+    import rustworkx as rx
+except ImportError:
+    rx = None
 
 
 ## Parameters
 pennDataPathPrefix = ""
 shpFileSuffix = "PA_VTD.shp"
 jsonFileSuffix = "PA_VTD.json"
+measure_memory = False  # report the peak memory used while running a ReCom chain
+total_steps = 1000  # length of the ReCom ensemble
+n_chains = 10  # number of independent ReCom chains the ensemble is split into
+min_steps_per_chain = 100  # shortest ReCom chain in the ensemble
+base_seed = None  # set to an integer to get the same ReCom ensemble on every run
+
+# No more chains than leave each one min_steps_per_chain steps. This depends
+# only on the parameters above, not on the machine, so the same parameters
+# and base_seed give the same ensemble everywhere.
+n_chains = max(1, min(n_chains, total_steps // min_steps_per_chain))
+
+# Number of processes to run the chains in: one per core this process may
+# use, but no more than there are chains.
+if hasattr(os, "sched_getaffinity"):
+    n_cores = len(os.sched_getaffinity(0))
+else:
+    n_cores = os.cpu_count() or 1
+n_workers = min(n_cores, n_chains)
 
 
 
@@ -39,11 +80,56 @@ jsonFileSuffix = "PA_VTD.json"
 #### Depending on the size of the state, the process of generating an adjacency
 #### graph can take a bit of time. To avoid having to repeat this process in
 #### the future, we call graph.to_json() to save the graph in the NetworkX
-#### json_graph format under the name "PA_VTD.json.
-
-graph = Graph.from_file(pennDataPathPrefix+shpFileSuffix)
-
-graph.to_json(pennDataPathPrefix+jsonFileSuffix)
+#### json_graph format under the name "PA_VTD.json. On later runs we load
+#### that file with Graph.from_json() instead of rebuilding the graph.
+
+if os.path.exists(pennDataPathPrefix+jsonFileSuffix):
+    graph = Graph.from_json(pennDataPathPrefix+jsonFileSuffix)
+else:
+    graph = Graph.from_file(pennDataPathPrefix+shpFileSuffix)
+    graph.to_json(pennDataPathPrefix+jsonFileSuffix)
+
+#### The graph never changes while a chain runs, so we build some lookup tables
+#### from it once, here. The node and edge lists are used to set up the arrays
+#### and the rustworkx graph below, and node_neighbors is what the pure-Python
+#### contiguity check searches at every flip when Numba isn't installed.
+#### (GerryChain's own updaters, such as cut_edges, still use NetworkX views.)
+
+nodes = list(graph.nodes)
+edges = list(graph.edges)
+node_neighbors = {node: frozenset(graph.neighbors(node)) for node in nodes}
+
+#### For the NumPy and Numba code below we also number the nodes 0, 1, 2, ...
+#### and store the adjacency in compressed sparse row (CSR) form: the neighbors
+#### of node i are indices[indptr[i]:indptr[i + 1]]. Districts are numbered
+#### the same way.
+
+node_index = {node: i for i, node in enumerate(nodes)}
+
+indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+indptr[1:] = np.cumsum([len(node_neighbors[node]) for node in nodes])
+indices = np.fromiter((node_index[neighbor] for node in nodes
+                       for neighbor in node_neighbors[node]),
+                      dtype=np.int64, count=indptr[-1])
+
+districts = sorted({graph.nodes[node]["2011_PLA_1"] for node in nodes})
+district_index = {district: i for i, district in enumerate(districts)}
+n_districts = len(districts)
+
+#### This updater keeps a partition's assignment as an int32 array of district
+#### numbers, in node order. Each step copies the previous plan's array and
+#### changes only the entries of the flipped nodes.
+
+def assignment_array(partition):
+    """The partition's assignment as an array of district numbers."""
+    if partition.parent is None:
+        return np.fromiter((district_index[partition.assignment[node]] for node in nodes),
+                           dtype=np.int32, count=len(nodes))
+
+    array = partition.parent["assignment_array"].copy()
+    for node, part in partition.flips.items():
+        array[node_index[node]] = district_index[part]
+    return array
 
 ## Simple Example
 
@@ -69,7 +155,8 @@ initial_partition = Partition(
     updaters={
         "cut_edges": cut_edges,
         "population": Tally("TOT_POP", alias="population"),
-        "SEN12": election
+        "SEN12": election,
+        "assignment_array": assignment_array
     }
 )
 
@@ -77,8 +164,13 @@ initial_partition = Partition(
 #### in each of our congressional districts. In an interactive Python session,
 #### we can print out the populations like this:
 
-for district, pop in initial_partition["population"].items():
-    print("District {}: {}".format(district, pop))
+#### (The parts of this script that run chains or print output are wrapped in
+#### `if __name__ == "__main__":`, so the worker processes used for the ReCom
+#### chain below can import this file without running them again.)
+
+if __name__ == "__main__":
+    for district, pop in initial_partition["population"].items():
+        print("District {}: {}".format(district, pop))
 
 #### Notice that partition["population"] is a dictionary mapping the ID of each
 #### district to its total population (that’s why we can call the .items()
@@ -86,6 +178,94 @@ for district, pop in initial_partition["population"].items():
 
 #### For more information on updaters, see the gerrychain.updaters documentation.
 
+#### Contiguity
+#### Every flip must keep the district it removes a node from connected. This
+#### is what single_flip_contiguous checks; the version below does the same
+#### search using the neighbors we cached above. It is enough to check that
+#### the flipped node's old neighbors can still reach each other.
+
+def cached_single_flip_contiguous(partition):
+    """single_flip_contiguous, using the precomputed node_neighbors."""
+    if partition.parent is None or not partition.flips:
+        return single_flip_contiguous(partition)
+
+    assignment = partition.assignment
+    for node in partition.flips:
+        old_part = partition.parent.assignment[node]
+        old_neighbors = [neighbor for neighbor in node_neighbors[node]
+                         if assignment[neighbor] == old_part]
+        if not old_neighbors:
+            return False
+
+        start = old_neighbors[0]
+        targets = set(old_neighbors[1:])
+        seen = {start}
+        queue = deque([start])
+        while queue and targets:
+            for neighbor in node_neighbors[queue.popleft()] - seen:
+                if assignment[neighbor] == old_part:
+                    seen.add(neighbor)
+                    targets.discard(neighbor)
+                    queue.append(neighbor)
+        if targets:
+            return False
+    return True
+
+#### If Numba is installed, we compile the same search to machine code. It runs
+#### over the CSR adjacency and the assignment array instead of dicts.
+
+if njit is not None:
+    @njit(cache=True)
+    def _flip_keeps_contiguous(indptr, indices, assignment, node, old_part):
+        """Whether old_part stays connected after node was flipped out of it."""
+        is_target = np.zeros(assignment.shape[0], dtype=np.bool_)
+        n_targets = 0
+        start = -1
+        for k in range(indptr[node], indptr[node + 1]):
+            neighbor = indices[k]
+            if assignment[neighbor] == old_part:
+                is_target[neighbor] = True
+                n_targets += 1
+                start = neighbor
+        if n_targets == 0:
+            return False
+
+        seen = np.zeros(assignment.shape[0], dtype=np.bool_)
+        queue = np.empty(assignment.shape[0], dtype=np.int64)
+        seen[start] = True
+        queue[0] = start
+        head, tail = 0, 1
+        remaining = n_targets - 1
+        while head < tail and remaining > 0:
+            current = queue[head]
+            head += 1
+            for k in range(indptr[current], indptr[current + 1]):
+                neighbor = indices[k]
+                if not seen[neighbor] and assignment[neighbor] == old_part:
+                    seen[neighbor] = True
+                    queue[tail] = neighbor
+                    tail += 1
+                    if is_target[neighbor]:
+                        remaining -= 1
+        return remaining == 0
+
+    def numba_single_flip_contiguous(partition):
+        """single_flip_contiguous, using the compiled search."""
+        if partition.parent is None or not partition.flips:
+            return single_flip_contiguous(partition)
+
+        assignment = partition["assignment_array"]
+        old_assignment = partition.parent.assignment
+        for node in partition.flips:
+            if not _flip_keeps_contiguous(indptr, indices, assignment, node_index[node],
+                                          district_index[old_assignment[node]]):
+                return False
+        return True
+
+    flip_contiguous = numba_single_flip_contiguous
+else:
+    flip_contiguous = cached_single_flip_contiguous
+
 #### Running a chain
 #### Now that we have our initial partition, we can configure and run a Markov
 #### chain. Let’s configure a short Markov chain to make sure everything works
@@ -93,7 +273,7 @@ for district, pop in initial_partition["population"].items():
 
 chain = MarkovChain(
     proposal=propose_random_flip,
-    constraints=[single_flip_contiguous],
+    constraints=[flip_contiguous],
     accept=always_accept,
     initial_state=initial_partition,
     total_steps=1000
@@ -105,33 +285,37 @@ chain = MarkovChain(
 #### sorted vector of Democratic vote percentages in each district for each
 #### step in the chain.
 
-for partition in chain:
-    print(sorted(partition["SEN12"].percents("Dem")))
-
-#### That’s all: you’ve run a Markov chain!
+#### To analyze the vote percentages for each districting plan in our
+#### ensemble, we’ll want to actually collect the data, and not just print it
+#### out, so the same loop also stores each vector in a list. We then convert
+#### the list into a pandas DataFrame. Vote shares lie between 0 and 1, so we
+#### store them as float32, which takes half the memory of the default float64
+#### (check with data.memory_usage(deep=True).sum()).
 
-#### To analyze the Republican vote percentages for each districting plan in
-#### our ensemble, we’ll want to actually collect the data, and not just print
-#### it out. We can use a list comprehension to store these vote percentages,
-#### and then convert it into a pandas DataFrame.
+if __name__ == "__main__":
+    d_percents = []
+    for partition in chain:
+        d_percents.append(sorted(partition["SEN12"].percents("Dem")))
+        print(d_percents[-1])
 
-d_percents = [sorted(partition["SEN12"].percents("Dem")) for partition in chain]
+    data = pd.DataFrame(d_percents, dtype=np.float32)
 
-data = pd.DataFrame(d_percents)
+#### That’s all: you’ve run a Markov chain!
 
-#### This code will collect data from a different ensemble than our for loop
-#### above. Each time we iterate through the chain object, we run a fresh new
-#### Markov chain (using the same configuration that we defined when
-#### instantiating chain).
+#### Each time we iterate through the chain object, we run a fresh new Markov
+#### chain (using the same configuration that we defined when instantiating
+#### chain), so we collect and print in a single pass rather than running the
+#### chain once for each.
 
 #### The pandas DataFrame object has many helpful methods for analyzing and
 #### plotting data. For example, we can produce a boxplot of our ensemble’s
 #### Democratic vote percentage vectors, with the initial 2011 districting plan
 #### plotted in red, in just a few lines of code:
-ax = data.boxplot()
-data.iloc[0].plot(style="ro", ax=ax)
+if __name__ == "__main__":
+    ax = data.boxplot()
+    data.iloc[0].plot(style="ro", ax=ax)
 
-plt.show()
+    plt.show()
 
 #### (Before you over-analyze this data, keep in mind that this is a toy
 #### ensemble of just one thousand plans created by single flips.)
@@ -162,25 +346,90 @@ elections = [
 #### We want to set up updaters for everything we want to compute for each plan
 #### in the ensemble.
 
+# The updaters below read node data from a NumPy array, built once here,
+# instead of looking up graph.nodes[node][column] at every step. Each row is
+# a node and each column one of the data columns we aggregate: TOT_POP and
+# the vote totals of every election.
+columns = ["TOT_POP"] + [column for election in elections
+                         for column in election.parties_to_columns.values()]
+column_index = {column: j for j, column in enumerate(columns)}
+node_weights = np.array([[graph.nodes[node][column] for column in columns]
+                         for node in nodes], dtype=np.float64)
+
+# All the district totals are computed together: row d of
+# partition["district_totals"] holds the totals of every column for district
+# d. The other updaters just take columns of it. For the initial plan this is
+# a sparse product S @ node_weights, where S is the (districts x nodes) matrix
+# with a 1 for each node in its district. After that, a step adds the rows of
+# the nodes that moved to their new district and subtracts them from the old
+# one, which is another sparse product over just those nodes.
+def district_totals(partition):
+    """Totals of every column in node_weights, by district number."""
+    assignment = partition["assignment_array"]
+    if partition.parent is None:
+        membership = csr_matrix(
+            (np.ones(len(nodes)), (assignment, np.arange(len(nodes)))),
+            shape=(n_districts, len(nodes)))
+        return membership @ node_weights
+
+    flipped = np.fromiter((node_index[node] for node in partition.flips),
+                          dtype=np.int64, count=len(partition.flips))
+    old_parts = partition.parent["assignment_array"][flipped]
+    new_parts = assignment[flipped]
+    moved = old_parts != new_parts
+    flipped, old_parts, new_parts = flipped[moved], old_parts[moved], new_parts[moved]
+
+    n_moved = len(flipped)
+    change = csr_matrix(
+        (np.concatenate([np.ones(n_moved), -np.ones(n_moved)]),
+         (np.concatenate([new_parts, old_parts]), np.tile(np.arange(n_moved), 2))),
+        shape=(n_districts, n_moved))
+    return partition.parent["district_totals"] + change @ node_weights[flipped]
+
 # Population updater, for computing how close to equality the district
 # populations are. "TOT_POP" is the population column from our shapefile.
-my_updaters = {"population": updaters.Tally("TOT_POP", alias="population")}
+def population_array(partition):
+    """Total population of each district, indexed by district number."""
+    return partition["district_totals"][:, column_index["TOT_POP"]]
+
+my_updaters = {
+    "assignment_array": assignment_array,
+    "district_totals": district_totals,
+    "population_array": population_array
+}
 
 # Election updaters, for computing election results using the vote totals
-# from our shapefile.
-election_updaters = {election.name: election for election in elections}
-my_updaters.update(election_updaters)
+# from our shapefile. Like the population, these are columns of
+# district_totals: for each election we add an updater for the Democratic
+# vote share in each district, e.g. partition["SEN12_dem_percents"]. The
+# Election objects above only tell us which columns to use. If you want
+# GerryChain's full election results too (for example to compute
+# efficiency_gap), add {election.name: election for election in elections}
+# to my_updaters.
+def dem_percents(election):
+    """An updater for the Democratic vote share of each district in election."""
+    dem = column_index[election.parties_to_columns["Democratic"]]
+    rep = column_index[election.parties_to_columns["Republican"]]
+
+    def updater(partition):
+        totals = partition["district_totals"]
+        return totals[:, dem] / (totals[:, dem] + totals[:, rep])
+    return updater
+
+for election in elections:
+    my_updaters[election.name + "_dem_percents"] = dem_percents(election)
 
 #### Instantiating the partition
 #### We can now instantiate the initial state of our Markov chain, using the 2011 districting plan:
 
-initial_partition = GeographicPartition(graph,
-                                        assignment="2011_PLA_1",
-                                        updaters=my_updaters)
+initial_partition = Partition(graph,
+                              assignment="2011_PLA_1",
+                              updaters=my_updaters)
 
-#### GeographicPartition comes with built-in area and perimeter updaters. We do
-#### not use them here, but they would allow us to compute compactness scores
-#### like Polsby-Popper that depend on these measurements.
+#### ReCom only needs the adjacency graph, so a plain Partition will do; it
+#### comes with the cut_edges updater by default. A GeographicPartition would
+#### add built-in area and perimeter updaters, which allow compactness scores
+#### like Polsby-Popper, but we do not use them here.
 
 
 #### Setting up the Markov chain
@@ -191,15 +440,62 @@ initial_partition = GeographicPartition(graph,
 # The ReCom proposal needs to know the ideal population for the districts so that
 # we can improve speed by bailing early on unbalanced partitions.
 
-ideal_population = sum(initial_partition["population"].values()) / len(initial_partition)
-
-# We use functools.partial to bind the extra parameters (pop_col, pop_target, epsilon, node_repeats)
-# of the recom proposal.
+ideal_population = initial_partition["population_array"].mean()
+
+#### Most of the time of a ReCom step goes into drawing a random spanning tree
+#### of the two merged districts, which GerryChain does with NetworkX in pure
+#### Python. If rustworkx is installed, we pass recom a bipartition method that
+#### draws the trees with rustworkx instead, and otherwise works exactly like
+#### GerryChain's bipartition_tree: the same leaf contraction picks the cut, so
+#### both versions sample the same ensemble. rustworkx works on a copy of the
+#### graph whose nodes are numbered like node_index, built once here.
+
+if rx is not None:
+    rx_graph = rx.PyGraph()
+    rx_graph.add_nodes_from(range(len(nodes)))
+    rx_graph.add_edges_from_no_data([(node_index[u], node_index[v]) for u, v in edges])
+
+def rx_random_spanning_tree(graph):
+    """A random spanning tree of graph, a subgraph of ours, drawn with rustworkx.
+
+    Like gerrychain.tree.random_spanning_tree, this gives every edge a random
+    weight and takes the optimal spanning tree for those weights. The tree
+    is returned as a NetworkX graph on the original node labels.
+    """
+    region = rx_graph.subgraph([node_index[node] for node in graph])
+    tree = rx.minimum_spanning_tree(region, weight_fn=lambda _: random.random())
+
+    spanning_tree = nx.Graph()
+    spanning_tree.add_nodes_from(graph)
+    spanning_tree.add_edges_from((nodes[tree[u]], nodes[tree[v]])
+                                 for u, v in tree.edge_list())
+    return spanning_tree
+
+def rx_bipartition_tree(graph, pop_col, pop_target, epsilon, node_repeats=1):
+    """gerrychain.tree.bipartition_tree, drawing its spanning trees with rustworkx."""
+    populations = {node: graph.nodes[node][pop_col] for node in graph}
+
+    balanced_subtree = None
+    spanning_tree = rx_random_spanning_tree(graph)
+    restarts = 0
+    while balanced_subtree is None:
+        if restarts == node_repeats:
+            spanning_tree = rx_random_spanning_tree(graph)
+            restarts = 0
+        h = PopulatedGraph(spanning_tree, populations, pop_target, epsilon)
+        balanced_subtree = contract_leaves_until_balanced_or_none(h)
+        restarts += 1
+
+    return balanced_subtree
+
+# We use functools.partial to bind the extra parameters (pop_col, pop_target,
+# epsilon, node_repeats, method) of the recom proposal.
 proposal = partial(recom,
                    pop_col="TOT_POP",
                    pop_target=ideal_population,
                    epsilon=0.02,
-                   node_repeats=2
+                   node_repeats=2,
+                   method=rx_bipartition_tree if rx is not None else bipartition_tree
                   )
 
 #### Constraints
@@ -207,72 +503,157 @@ proposal = partial(recom,
 #### number of cut edges at 2 times the number of cut edges in the initial
 #### plan.
 
-compactness_bound = constraints.UpperBound(
-    lambda p: len(p["cut_edges"]),
-    2*len(initial_partition["cut_edges"])
-)
+def cut_edges_count(partition):
+    """Number of cut edges, from the partition's cached cut_edges set.
 
-pop_constraint = constraints.within_percent_of_ideal_population(initial_partition, 0.02)
+    The ReCom proposal already needs partition["cut_edges"] at every step to
+    pick the two districts to merge, and GerryChain updates and caches that
+    set on the partition, so we only need to count its elements.
+    """
+    return len(partition["cut_edges"])
 
-#### Configuring the Markov chain
-chain = MarkovChain(
-    proposal=proposal,
-    constraints=[
-        pop_constraint,
-        compactness_bound
-    ],
-    accept=accept.always_accept,
-    initial_state=initial_partition,
-    total_steps=1000
+compactness_bound = constraints.UpperBound(
+    cut_edges_count,
+    2*cut_edges_count(initial_partition)
 )
 
-#### Running the chain
-#### Now we’ll run the chain, putting the sorted Democratic vote percentages
-#### directly into a pandas DataFrame for analysis and plotting. The DataFrame
-#### will have a row for each state of the chain. The first column of the
-#### DataFrame will hold the lowest Democratic vote share among the districts
-#### in each partition in the chain, the second column will hold the
-#### second-lowest Democratic vote shares, and so on.
-
-# This will take about 10 minutes.
-
-
-#data = pd.DataFrame(
-#    sorted(partition["SEN12"].percents("Democratic"))
-#    for partition in chain
-#)
-
-#### If you install the tqdm package, you can see a progress bar as the chain
-#### runs by running this code instead:
-
-data = pd.DataFrame(
-   sorted(partition["SEN12"].percents("Democratic"))
-   for partition in chain.with_progress_bar()
-)
+#### We also keep every district within 2% of the ideal population. The
+#### district populations are already an array, so this is one vectorized
+#### comparison instead of a loop over a dict.
+
+pop_tolerance = 0.02*ideal_population
+
+def pop_constraint(partition):
+    """Whether every district is within 2% of the ideal population."""
+    deviations = np.abs(partition["population_array"] - ideal_population)
+    return bool(np.all(deviations <= pop_tolerance))
+
+#### Configuring and running the Markov chain
+#### ReCom takes a while per step, but chains started from the same plan with
+#### different random seeds are independent of each other. So instead of one
+#### chain of total_steps steps we run n_chains shorter chains, spread over
+#### n_workers processes, and stack their results into a single ensemble.
+#### Each chain gets its own seed, drawn from base_seed, so the ensemble does
+#### not depend on how many processes run it.
+
+#### This is not the same as one long chain: every chain starts at the 2011
+#### plan, and a short chain doesn't get far from it. To keep the ensemble
+#### from turning into many short walks around the initial plan, each chain
+#### runs at least min_steps_per_chain steps, which limits n_chains (see the
+#### parameters at the top). Lower n_chains to trade speed for longer chains.
+
+#### Each chain puts its sorted Democratic vote percentages into a NumPy array
+#### with a row for each state of the chain, allocated up front. The first
+#### column holds the lowest Democratic vote share among the districts in each
+#### partition in the chain, the second column holds the second-lowest
+#### Democratic vote shares, and so on.
+
+def run_chain(index, seed, steps):
+    """Run ReCom chain number index from the 2011 plan, seeded with seed.
+
+    Returns a (steps, n_districts) float32 array of the sorted Democratic
+    vote shares (Senate 2012) of each state. Only chain 0 includes the 2011
+    plan itself; the others leave it out and run one step further instead,
+    so that the ensemble holds a single copy of it.
+    """
+    # Every chain needs its own random state, or they would all produce the
+    # same chain.
+    random.seed(seed)
+    np.random.seed(seed)
+    skip = 0 if index == 0 else 1
+
+    chain = MarkovChain(
+        proposal=proposal,
+        # Counting the cached cut edges is cheaper than building the district
+        # totals that the population check needs, so we check compactness
+        # first and reject proposals that break it before those totals are
+        # computed. (recom only checks the population of one side of its
+        # split, so pop_constraint still rejects some proposals.)
+        constraints=[
+            compactness_bound,
+            pop_constraint
+        ],
+        accept=accept.always_accept,
+        initial_state=initial_partition,
+        total_steps=steps + skip
+    )
+
+    # tqdm shows a progress bar for each chain. It only redraws every 100
+    # steps and at most twice a second, so drawing the bar doesn't slow the
+    # chain down.
+    progress = tqdm.tqdm(chain, total=steps + skip, position=index,
+                         miniters=100, mininterval=0.5, smoothing=0)
+    d_percents = np.empty((steps, n_districts), dtype=np.float32)
+
+    # With measure_memory set, tracemalloc follows the memory the first chain
+    # allocates while it runs. We start it after allocating d_percents so that
+    # the result array, which has the same size however the chain behaves, is
+    # left out.
+    measuring = measure_memory and index == 0
+    if measuring:
+        tracemalloc.start()
+
+    for i, partition in enumerate(progress):
+        if i < skip:
+            continue
+        # Copy the vote shares into this step's row and sort it in place. (The
+        # updater's own array is cached on the partition, so we leave it as is.)
+        row = d_percents[i - skip]
+        row[:] = partition["SEN12_dem_percents"]
+        row.sort()
+
+    # The peak is the most memory the chain's partitions and updaters held at
+    # once. tqdm.write prints it without breaking up the progress bars.
+    if measuring:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        tqdm.tqdm.write("Chain 0: peak memory allocated while running {} steps: "
+                        "{:.1f} MB".format(steps + skip, peak / 1e6))
+
+    return d_percents
+
+#### Chain 0 comes first and is the only one that records the 2011 plan, so
+#### the first row of the combined DataFrame is the initial plan.
+
+# This will take about 10 minutes divided by n_workers.
+
+if __name__ == "__main__":
+    # With base_seed = None, random.Random draws its seed from the operating
+    # system, so every run samples a new ensemble.
+    seed_generator = random.Random(base_seed)
+    seeds = [seed_generator.randrange(2**32) for _ in range(n_chains)]
+    steps_per_chain = [total_steps // n_chains + (index < total_steps % n_chains)
+                       for index in range(n_chains)]
+    with mp.Pool(n_workers) as pool:
+        d_percents = pool.starmap(run_chain, zip(range(n_chains), seeds, steps_per_chain))
+
+    # d_percents is already float32, so the DataFrame keeps that dtype.
+    data = pd.DataFrame(np.vstack(d_percents))
 
 
 #### Create a plot
 #### Now we’ll create a box plot similar to those appearing the Virginia report.
 
-fig, ax = plt.subplots(figsize=(8, 6))
+if __name__ == "__main__":
+    fig, ax = plt.subplots(figsize=(8, 6))
 
-# Draw 50% line
-ax.axhline(0.5, color="#cccccc")
+    # Draw 50% line
+    ax.axhline(0.5, color="#cccccc")
 
-# Draw boxplot
-data.boxplot(ax=ax, positions=range(len(data.columns)))
+    # Draw boxplot
+    data.boxplot(ax=ax, positions=range(len(data.columns)))
 
-# Draw initial plan's Democratic vote %s (.iloc[0] gives the first row)
-data.iloc[0].plot(style="ro", ax=ax)
+    # Draw initial plan's Democratic vote %s (.iloc[0] gives the first row)
+    data.iloc[0].plot(style="ro", ax=ax)
 
-# Annotate
-ax.set_title("Comparing the 2011 plan to an ensemble")
-ax.set_ylabel("Democratic vote % (Senate 2012)")
-ax.set_xlabel("Sorted districts")
-ax.set_ylim(0, 1)
-ax.set_yticks([0, 0.25, 0.5, 0.75, 1])
+    # Annotate
+    ax.set_title("Comparing the 2011 plan to an ensemble")
+    ax.set_ylabel("Democratic vote % (Senate 2012)")
+    ax.set_xlabel("Sorted districts")
+    ax.set_ylim(0, 1)
+    ax.set_yticks([0, 0.25, 0.5, 0.75, 1])
 
-plt.show()
+    plt.show()
 
 #### There you go! To build on this, here are some possible next steps:
 